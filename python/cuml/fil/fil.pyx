@@ -132,6 +132,29 @@ cdef class TreeliteModel():
         model.set_handle(handle)
         return model
 
+    @staticmethod
+    def from_xgboost_bytes(buf):
+        """
+        Returns a TreeliteModel object loaded from an XGBoost model held
+        in memory, e.g. the output of xgboost.Booster.save_raw()
+
+        Parameters
+        ----------
+        buf : bytes-like
+            Serialized XGBoost model
+        """
+        cdef bytes buf_bytes = bytes(buf)
+        cdef const char* buf_ptr = buf_bytes
+        cdef ModelHandle handle
+        res = TreeliteLoadXGBoostModelFromMemoryBuffer(buf_ptr,
+                                                       len(buf_bytes),
+                                                       &handle)
+        if res < 0:
+            raise RuntimeError("Failed to load XGBoost model from buffer")
+        model = TreeliteModel()
+        model.set_handle(handle)
+        return model
+
 
 cdef extern from "cuml/fil/fil.h" namespace "ML::fil":
     cdef enum algo_t:
@@ -202,7 +225,7 @@ cdef class ForestInference_impl():
                              ' to the documentation')
         return storage_type_dict[storage_type_str]
 
-    def predict(self, X, preds=None):
+    def predict(self, X, preds=None, convert_dtype=False):
         """
         Returns the results of forest inference on the exampes in X
 
@@ -212,10 +235,15 @@ cdef class ForestInference_impl():
             For optimal performance, pass a device array with C-style layout
 
         preds : float32 device array, shape = n_samples
+
+        convert_dtype : bool, optional (default = False)
+            When set to True, X is converted to float32 if needed
         """
         cdef uintptr_t X_ptr
         X_m, X_ptr, n_rows, _, X_dtype = \
-            input_to_dev_array(X, order='C', check_dtype=np.float32)
+            input_to_dev_array(X, order='C', check_dtype=np.float32,
+                               convert_to_dtype=(np.float32 if convert_dtype
+                                                 else None))
 
         cdef cumlHandle* handle_ =\
             <cumlHandle*><size_t>self.handle.getHandle()
@@ -358,7 +386,7 @@ class ForestInference(Base):
         super(ForestInference, self).__init__(handle)
         self._impl = ForestInference_impl(self.handle)
 
-    def predict(self, X, preds=None):
+    def predict(self, X, preds=None, convert_dtype=False):
         """
         Predicts the labels for X with the loaded forest model.
         By default, the result is the raw floating point output
@@ -376,13 +404,18 @@ class ForestInference(Base):
            For optimal performance, pass a device array with C-style layout
         preds: gpuarray or cudf.Series, shape = (n_samples,)
            Optional 'out' location to store inference results
+        convert_dtype : bool, optional (default = False)
+           When set to True, the predict method will automatically
+           convert X to float32, e.g. to keep a smaller float16 copy of
+           the data on the device. Inference itself is always done in
+           float32.
 
         Returns
         ----------
         GPU array of length n_samples with inference results
         (or 'preds' filled with inference results if preds was specified)
         """
-        return self._impl.predict(X, preds)
+        return self._impl.predict(X, preds, convert_dtype)
 
     def load_from_treelite_model(self, model, output_class,
                                  algo='TREE_REORG',
@@ -13,18 +13,22 @@
 # limitations under the License.
 #
 
+import ctypes
+import cupy as cp
 import numpy as np
 import pytest
 import os
 
+from numba import cuda
+
+import cuml
 from cuml import ForestInference
-from cuml.test.utils import array_equal, unit_param, \
-    quality_param, stress_param
+from cuml.fil.fil import TreeliteModel
+from cuml.utils import checked_cupy_fn
+from cuml.test.utils import unit_param, quality_param, stress_param
 from cuml.utils.import_utils import has_xgboost, has_lightgbm
 
 from sklearn.datasets import make_classification, make_regression
-from sklearn.metrics import accuracy_score, mean_squared_error
-from sklearn.model_selection import train_test_split
 
 if has_xgboost():
     import xgboost as xgb
@@ -42,8 +46,95 @@ if has_xgboost():
                                                n_informative=int(n/5),
                                                n_targets=1,
                                                random_state=random_state)
-        return np.c_[features].astype(np.float32), \
-            np.c_[labels].astype(np.float32).flatten()
+        return np.ascontiguousarray(features, dtype=np.float32), \
+            np.ascontiguousarray(labels, dtype=np.float32).ravel()
+
+
+def simulate_data_gpu(m, n, random_state=None, classification=True):
+    """Generates the data on the device and returns it as cupy arrays.
+    Binary classification labels are obtained by thresholding the
+    regression target at zero"""
+    features, values = cuml.make_regression(n_samples=m,
+                                            n_features=n,
+                                            n_informative=int(n/5),
+                                            n_targets=1,
+                                            random_state=random_state,
+                                            dtype=np.float32)
+    features = checked_cupy_fn(cp.asarray, features)
+    labels = checked_cupy_fn(cp.asarray, values).ravel()
+    if classification:
+        labels = (labels > 0).astype(np.float32)
+    return features, labels
+
+
+def _asnumpy_async(X, stream):
+    """Starts copying the C-contiguous device array X into pinned host
+    memory on stream and returns the host array, which is valid once stream
+    is synchronized. X must stay alive until then. The copy only overlaps
+    with CPU work: other device to host copies share the same link"""
+    assert X.flags.c_contiguous
+    # X is produced on the null stream, which a non-blocking stream
+    # doesn't implicitly wait for
+    cp.cuda.Stream.null.synchronize()
+    mem = cp.cuda.alloc_pinned_memory(X.nbytes)
+    X_h = np.frombuffer(mem, X.dtype, X.size).reshape(X.shape)
+    X.data.copy_to_host_async(ctypes.c_void_p(X_h.ctypes.data), X.nbytes,
+                              stream=stream)
+    return X_h
+
+
+@pytest.fixture(scope="module")
+def fil_data():
+    """Returns a function giving the simulated validation rows for
+    (n_rows, n_columns, classification, seed), along with the xgboost
+    matrices for both halves. Each configuration is generated only once:
+    (X_validation, y_validation, dtrain, dvalidation)"""
+    cache = {}
+
+    def get(n_rows, n_columns, classification, seed):
+        key = (n_rows, n_columns, classification, seed)
+        if key not in cache:
+            train_size = 0.80
+            X, y = simulate_data_gpu(n_rows, n_columns,
+                                     random_state=seed,
+                                     classification=classification)
+            # the generated rows are already shuffled, so the split is a
+            # slice; the validation rows are checked on the device
+            n_train = int(n_rows * train_size)
+            # copy, so that the cache doesn't keep all of X alive
+            X_validation, y_validation = X[n_train:].copy(), \
+                y[n_train:].copy()
+
+            X_train, y_train = cp.asnumpy(X[:n_train]), \
+                cp.asnumpy(y[:n_train])
+
+            # the host copy of the validation rows, only needed by xgboost,
+            # is made on its own stream while xgboost builds the training
+            # matrix on the CPU
+            stream = cp.cuda.Stream(non_blocking=True)
+            X_validation_h = _asnumpy_async(X_validation, stream)
+            dtrain = _make_train_dmatrix(X_train, y_train)
+            stream.synchronize()
+            dvalidation = xgb.DMatrix(X_validation_h,
+                                      label=cp.asnumpy(y_validation))
+            cache[key] = (X_validation, y_validation, dtrain, dvalidation)
+        return cache[key]
+
+    return get
+
+
+# number of histogram bins used by the reference xgboost models
+XGB_MAX_BIN = 256
+
+
+def _make_train_dmatrix(X_train, y_train):
+    """Returns a training matrix for the hist tree methods. QuantileDMatrix
+    (xgboost >= 1.7) quantizes the data once instead of keeping a full copy
+    around for xgboost to bin again"""
+    if hasattr(xgb, 'QuantileDMatrix'):
+        return xgb.QuantileDMatrix(X_train, label=y_train,
+                                   max_bin=XGB_MAX_BIN)
+    return xgb.DMatrix(X_train, label=y_train)
 
 
 def _build_and_save_xgboost(model_path,
@@ -53,8 +144,20 @@ def _build_and_save_xgboost(model_path,
                             num_rounds=5,
                             xgboost_params={}):
     """Trains a small xgboost classifier and saves it to model_path"""
-    dtrain = xgb.DMatrix(X_train, label=y_train)
+    dtrain = _make_train_dmatrix(X_train, y_train)
+    bst = _train_xgboost(dtrain,
+                         classification=classification,
+                         num_rounds=num_rounds,
+                         xgboost_params=xgboost_params)
+    bst.save_model(model_path)
+    return bst
+
 
+def _train_xgboost(dtrain,
+                   classification=True,
+                   num_rounds=5,
+                   xgboost_params={}):
+    """Trains an xgboost model on dtrain"""
     # instantiate params
     params = {'silent': 1}
 
@@ -67,116 +170,155 @@ def _build_and_save_xgboost(model_path,
         params['objective'] = 'reg:squarederror'
         params['base_score'] = 0.0
 
-    params['max_depth'] = 25
+    params['max_depth'] = 6
+    params['tree_method'] = 'gpu_hist' if cuda.is_available() else 'hist'
+    params['max_bin'] = XGB_MAX_BIN
+    # split the cores between pytest-xdist workers to avoid oversubscribing
+    n_workers = int(os.environ.get('PYTEST_XDIST_WORKER_COUNT', 1))
+    params['nthread'] = max(1, (os.cpu_count() or 1) // n_workers)
     params.update(xgboost_params)
 
-    bst = xgb.train(params, dtrain, num_rounds)
-    bst.save_model(model_path)
-    return bst
+    return xgb.train(params, dtrain, num_rounds)
+
+
+@pytest.fixture(scope="module")
+def xgboost_models():
+    """Returns a function training an xgboost model on dtrain, only the
+    first time a configuration is seen. The model is handed to treelite in
+    memory rather than through a saved file: (bst, tl_model)"""
+    cache = {}
+
+    def get(dtrain, seed, classification=True, num_rounds=5,
+            xgboost_params={}):
+        key = (dtrain.num_row(), dtrain.num_col(), num_rounds,
+               classification, xgboost_params.get('max_depth'), seed)
+        if key not in cache:
+            bst = _train_xgboost(dtrain,
+                                 classification=classification,
+                                 num_rounds=num_rounds,
+                                 xgboost_params=xgboost_params)
+            tl_model = TreeliteModel.from_xgboost_bytes(bst.save_raw())
+            cache[key] = (bst, tl_model)
+        return cache[key]
+
+    return get
 
 
-@pytest.mark.parametrize('n_rows', [unit_param(1000),
-                                    quality_param(10000),
-                                    stress_param(500000)])
-@pytest.mark.parametrize('n_columns', [unit_param(11),
-                                       quality_param(100),
-                         stress_param(1000)])
-@pytest.mark.parametrize('num_rounds', [unit_param(1),
-                                        unit_param(5),
-                                        quality_param(50),
-                                        stress_param(90)])
+# (n_rows, n_columns, num_rounds)
+FIL_CLS_CASES = [unit_param(1000, 11, 1),
+                 unit_param(1000, 11, 5),
+                 quality_param(10000, 100, 50),
+                 stress_param(500000, 1000, 90)]
+
+# (n_rows, n_columns, num_rounds, max_depth)
+FIL_REG_CASES = [unit_param(1000, 11, 5, 3),
+                 unit_param(1000, 11, 5, 7),
+                 quality_param(10000, 100, 10, 7),
+                 stress_param(500000, 1000, 90, 11)]
+
+
+@pytest.mark.parametrize('n_rows,n_columns,num_rounds', FIL_CLS_CASES)
 @pytest.mark.skipif(has_xgboost() is False, reason="need to install xgboost")
-def test_fil_classification(n_rows, n_columns, num_rounds, tmp_path):
+def test_fil_classification(n_rows, n_columns, num_rounds, fil_data,
+                            xgboost_models):
     # settings
     classification = True  # change this to false to use regression
-    n_rows = n_rows  # we'll use 1 millions rows
-    n_columns = n_columns
-    n_categories = 2
-    random_state = np.random.RandomState(43210)
+    seed = 43210
 
-    X, y = simulate_data(n_rows, n_columns, n_categories,
-                         random_state=random_state,
-                         classification=classification)
-    # identify shape and indices
-    n_rows, n_columns = X.shape
-    train_size = 0.80
+    X_validation, y_validation, dtrain, dvalidation = \
+        fil_data(n_rows, n_columns, classification, seed)
 
-    X_train, X_validation, y_train, y_validation = train_test_split(
-        X, y, train_size=train_size, random_state=0)
+    bst, tl_model = xgboost_models(
+        dtrain, seed,
+        classification=classification,
+        num_rounds=num_rounds)
 
-    model_path = os.path.join(tmp_path, 'xgb_class.model')
-
-    bst = _build_and_save_xgboost(model_path, X_train, y_train,
-                                  num_rounds, classification)
-
-    dvalidation = xgb.DMatrix(X_validation, label=y_validation)
     xgb_preds = bst.predict(dvalidation)
-    xgb_preds_int = np.around(xgb_preds)
+    xgb_preds_int = cp.asarray((xgb_preds > 0.5).astype(np.uint8))
 
-    xgb_acc = accuracy_score(y_validation, xgb_preds > 0.5)
+    xgb_acc = float((xgb_preds_int == y_validation).mean())
 
-    print("Reading the saved xgb model")
-
-    fm = ForestInference.load(model_path,
-                              algo='BATCH_TREE_REORG',
-                              output_class=True,
-                              threshold=0.50)
-    fil_preds = np.asarray(fm.predict(X_validation))
-    fil_acc = accuracy_score(y_validation, fil_preds)
+    fm = ForestInference()
+    fm.load_from_treelite_model(tl_model,
+                                algo='BATCH_TREE_REORG',
+                                output_class=True,
+                                threshold=0.50)
+    # keep the predictions on the device, only scalars are copied back
+    fil_preds = checked_cupy_fn(cp.asarray, fm.predict(X_validation))
+    fil_acc = float((fil_preds == y_validation).mean())
 
     print("XGB accuracy = ", xgb_acc, " ForestInference accuracy: ", fil_acc)
     assert fil_acc == pytest.approx(xgb_acc, 0.01)
-    assert array_equal(fil_preds, xgb_preds_int)
-
-
-@pytest.mark.parametrize('n_rows', [unit_param(1000), quality_param(10000),
-                         stress_param(500000)])
-@pytest.mark.parametrize('n_columns', [unit_param(11), quality_param(100),
-                         stress_param(1000)])
-@pytest.mark.parametrize('num_rounds', [unit_param(5), quality_param(10),
-                         stress_param(90)])
-@pytest.mark.parametrize('max_depth', [unit_param(3),
-                                       unit_param(7),
-                                       stress_param(11)])
+    assert cp.count_nonzero(fil_preds != xgb_preds_int).item() == 0
+
+
+@pytest.mark.parametrize('n_rows,n_columns,num_rounds,max_depth',
+                         FIL_REG_CASES)
 @pytest.mark.skipif(has_xgboost() is False, reason="need to install xgboost")
-def test_fil_regression(n_rows, n_columns, num_rounds, tmp_path, max_depth):
+def test_fil_regression(n_rows, n_columns, num_rounds, max_depth,
+                        fil_data, xgboost_models):
     # settings
     classification = False  # change this to false to use regression
-    n_rows = n_rows  # we'll use 1 millions rows
-    n_columns = n_columns
-    random_state = np.random.RandomState(43210)
-
-    X, y = simulate_data(n_rows, n_columns,
-                         random_state=random_state,
-                         classification=classification)
-    # identify shape and indices
-    n_rows, n_columns = X.shape
-    train_size = 0.80
-
-    X_train, X_validation, y_train, y_validation = train_test_split(
-        X, y, train_size=train_size, random_state=0)
-
-    model_path = os.path.join(tmp_path, 'xgb_reg.model')
-    bst = _build_and_save_xgboost(model_path, X_train,
-                                  y_train,
-                                  num_rounds,
-                                  classification,
-                                  xgboost_params={'max_depth': max_depth})
-
-    dvalidation = xgb.DMatrix(X_validation, label=y_validation)
-    xgb_preds = bst.predict(dvalidation)
+    seed = 43210
 
-    xgb_mse = mean_squared_error(y_validation, xgb_preds)
-    print("Reading the saved xgb model")
-    fm = ForestInference.load(model_path,
-                              algo='BATCH_TREE_REORG',
-                              output_class=False)
-    fil_preds = np.asarray(fm.predict(X_validation))
-    fil_mse = mean_squared_error(y_validation, fil_preds)
+    X_validation, y_validation, dtrain, dvalidation = \
+        fil_data(n_rows, n_columns, classification, seed)
+
+    bst, tl_model = xgboost_models(
+        dtrain, seed,
+        classification=classification,
+        num_rounds=num_rounds,
+        xgboost_params={'max_depth': max_depth})
+
+    xgb_preds = cp.asarray(bst.predict(dvalidation))
+
+    xgb_mse = float(((xgb_preds - y_validation) ** 2).mean())
+    fm = ForestInference()
+    fm.load_from_treelite_model(tl_model,
+                                algo='BATCH_TREE_REORG',
+                                output_class=False)
+    fil_preds = checked_cupy_fn(cp.asarray, fm.predict(X_validation))
+    fil_mse = float(((fil_preds - y_validation) ** 2).mean())
 
     print("XGB accuracy = ", xgb_mse, " Forest accuracy: ", fil_mse)
     assert fil_mse == pytest.approx(xgb_mse, 0.01)
-    assert array_equal(fil_preds, xgb_preds)
+    cp.testing.assert_allclose(fil_preds, xgb_preds, rtol=1e-5, atol=1e-4)
+
+
+# reuses FIL_REG_CASES configurations, so the models are already trained
+@pytest.mark.parametrize('n_rows,n_columns,num_rounds,max_depth',
+                         [unit_param(1000, 11, 5, 7),
+                          stress_param(500000, 1000, 90, 11)])
+@pytest.mark.skipif(has_xgboost() is False, reason="need to install xgboost")
+def test_fil_half_precision_input(n_rows, n_columns, num_rounds, max_depth,
+                                  fil_data, xgboost_models):
+    classification = False
+    seed = 43210
+
+    X_validation, y_validation, dtrain, dvalidation = \
+        fil_data(n_rows, n_columns, classification, seed)
+    bst, tl_model = xgboost_models(
+        dtrain, seed,
+        classification=classification,
+        num_rounds=num_rounds,
+        xgboost_params={'max_depth': max_depth})
+
+    # float16 values are exact in float32, so xgboost can score the same
+    # rounded inputs
+    X_half = X_validation.astype(np.float16)
+    xgb_preds = bst.predict(
+        xgb.DMatrix(cp.asnumpy(X_half).astype(np.float32)))
+
+    fm = ForestInference()
+    fm.load_from_treelite_model(tl_model,
+                                algo='BATCH_TREE_REORG',
+                                output_class=False)
+    with pytest.raises(TypeError):
+        fm.predict(X_half)
+    fil_preds = checked_cupy_fn(cp.asarray,
+                                fm.predict(X_half, convert_dtype=True))
+    cp.testing.assert_allclose(fil_preds, cp.asarray(xgb_preds),
+                               rtol=1e-5, atol=1e-4)
 
 
 @pytest.fixture(scope="session")
@@ -194,47 +336,82 @@ def small_classifier_and_preds(tmpdir_factory):
     return (model_path, X, xgb_preds)
 
 
+@pytest.fixture(scope="session")
+def loaded_fil(small_classifier_and_preds):
+    """Returns a function giving the small classifier loaded into FIL with
+    output_class=True for (algo, storage_type). The names are
+    case-insensitive, so each combination is only loaded once"""
+    model_path, _, _ = small_classifier_and_preds
+    cache = {}
+
+    def get(algo='TREE_REORG', storage_type='DENSE'):
+        key = (algo.upper(), storage_type.upper())
+        if key not in cache:
+            cache[key] = ForestInference.load(model_path,
+                                              algo=algo,
+                                              output_class=True,
+                                              storage_type=storage_type,
+                                              threshold=0.50)
+        return cache[key]
+
+    return get
+
+
+@pytest.fixture(scope="session")
+def preds_buf_alloc(small_classifier_and_preds):
+    """Device output buffer reused by every predict on the small classifier"""
+    _, X, _ = small_classifier_and_preds
+    return cp.empty(len(X), dtype=np.float32)
+
+
+@pytest.fixture
+def preds_buf(preds_buf_alloc):
+    # reset to a sentinel so results left over from a previous test
+    # can't pass for the output of a predict that wrote nothing
+    preds_buf_alloc.fill(np.nan)
+    return preds_buf_alloc
+
+
 @pytest.mark.skipif(has_xgboost() is False, reason="need to install xgboost")
 @pytest.mark.parametrize('algo', ['NAIVE', 'TREE_REORG', 'BATCH_TREE_REORG',
                                   'naive', 'tree_reorg', 'batch_tree_reorg'])
-def test_output_algos(algo, small_classifier_and_preds):
+def test_output_algos(algo, loaded_fil, small_classifier_and_preds,
+                      preds_buf):
     model_path, X, xgb_preds = small_classifier_and_preds
-    fm = ForestInference.load(model_path,
-                              algo=algo,
-                              output_class=True,
-                              threshold=0.50)
+    fm = loaded_fil(algo=algo)
+    assert fm._impl.get_algo(algo) == fm._impl.get_algo(algo.upper())
 
-    xgb_preds_int = np.around(xgb_preds)
-    fil_preds = np.asarray(fm.predict(X))
-    assert np.allclose(fil_preds, xgb_preds_int, 1e-3)
+    xgb_preds_int = (xgb_preds > 0.5).astype(np.uint8)
+    fil_preds = cp.asnumpy(fm.predict(X, preds=preds_buf))
+    assert np.array_equal(fil_preds, xgb_preds_int)
 
 
 @pytest.mark.skipif(has_xgboost() is False, reason="need to install xgboost")
 @pytest.mark.parametrize('storage_type',
                          ['AUTO', 'DENSE', 'SPARSE', 'auto', 'dense',
                           'sparse'])
-def test_output_storage_type(storage_type, small_classifier_and_preds):
+def test_output_storage_type(storage_type, loaded_fil,
+                             small_classifier_and_preds, preds_buf):
     model_path, X, xgb_preds = small_classifier_and_preds
-    fm = ForestInference.load(model_path,
-                              algo='NAIVE',
-                              output_class=True,
-                              storage_type=storage_type,
-                              threshold=0.50)
+    fm = loaded_fil(algo='NAIVE', storage_type=storage_type)
+    assert fm._impl.get_storage_type(storage_type) == \
+        fm._impl.get_storage_type(storage_type.upper())
 
-    xgb_preds_int = np.around(xgb_preds)
-    fil_preds = np.asarray(fm.predict(X))
-    assert np.allclose(fil_preds, xgb_preds_int, 1e-3)
+    xgb_preds_int = (xgb_preds > 0.5).astype(np.uint8)
+    fil_preds = cp.asnumpy(fm.predict(X, preds=preds_buf))
+    assert np.array_equal(fil_preds, xgb_preds_int)
 
 
 @pytest.mark.parametrize('output_class', [True, False])
 @pytest.mark.skipif(has_xgboost() is False, reason="need to install xgboost")
-def test_thresholding(output_class, small_classifier_and_preds):
+def test_thresholding(output_class, small_classifier_and_preds, preds_buf):
     model_path, X, xgb_preds = small_classifier_and_preds
     fm = ForestInference.load(model_path,
                               algo='TREE_REORG',
                               output_class=output_class,
                               threshold=0.50)
-    fil_preds = np.asarray(fm.predict(X))
+    fil_preds = cp.asnumpy(fm.predict(X, preds=preds_buf))
+    assert not np.isnan(fil_preds).any()
     if output_class:
         assert ((fil_preds != 0.0) & (fil_preds != 1.0)).sum() == 0
     else:
@@ -242,15 +419,16 @@ def test_thresholding(output_class, small_classifier_and_preds):
 
 
 @pytest.mark.skipif(has_xgboost() is False, reason="need to install xgboost")
-def test_output_args(small_classifier_and_preds):
+def test_output_args(small_classifier_and_preds, preds_buf):
     model_path, X, xgb_preds = small_classifier_and_preds
     fm = ForestInference.load(model_path,
                               algo='TREE_REORG',
                               output_class=False,
                               threshold=0.50)
     X = np.asarray(X)
-    fil_preds = fm.predict(X)
-    assert np.allclose(fil_preds, xgb_preds, 1e-3)
+    fil_preds = fm.predict(X, preds=preds_buf)
+    assert fil_preds is preds_buf
+    assert np.allclose(cp.asnumpy(fil_preds), xgb_preds, 1e-3)
 
 
 @pytest.mark.skipif(has_lightgbm() is False, reason="need to install lightgbm")
@@ -12,117 +12,116 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import cuml
 import numpy as np
 import pytest
+import rmm
 
 from cuml import TruncatedSVD as cuTSVD
 from cuml.test.utils import get_handle
-from cuml.test.utils import array_equal, unit_param, \
+from cuml.test.utils import array_equal, to_nparray, unit_param, \
     quality_param, stress_param
 
-from sklearn.datasets.samples_generator import make_blobs
 from sklearn.decomposition import TruncatedSVD as skTSVD
 from sklearn.utils import check_random_state
 
 
-@pytest.mark.parametrize('datatype', [np.float32, np.float64])
-@pytest.mark.parametrize('use_handle', [True, False])
-@pytest.mark.parametrize('name', [unit_param(None), quality_param('random'),
-                         stress_param('blobs')])
-def test_tsvd_fit(datatype, name, use_handle):
+@pytest.fixture(scope="module", autouse=True)
+def rmm_pool():
+    # serve this module's device allocations, e.g. the blobs dataset, from a
+    # pool instead of going through cudaMalloc/cudaFree for every array
+    rmm.reinitialize(pool_allocator=True, initial_pool_size=2 << 30)
+    yield
+    rmm.reinitialize(pool_allocator=False)
 
-    if name == 'blobs':
-        X, y = make_blobs(n_samples=500000,
-                          n_features=1000, random_state=0)
 
-    elif name == 'random':
-        pytest.skip('fails when using random dataset '
-                    'used by sklearn for testing')
-        shape = 5000, 100
-        rng = check_random_state(42)
-        X = rng.randint(-100, 20, np.product(shape)).reshape(shape)
+@pytest.fixture(scope="session")
+def tsvd_handle(request):
+    """(handle, stream) pair shared by all tests using the same
+    `use_handle` value, so library handles are only set up once"""
+    return get_handle(request.param)
 
-    else:
-        X = np.array([[-1, -1], [-2, -1], [-3, -2], [1, 1], [2, 1], [3, 2]],
-                     dtype=datatype)
 
-    if name != 'blobs':
-        sktsvd = skTSVD(n_components=1)
-        sktsvd.fit(X)
-
-    handle, stream = get_handle(use_handle)
-    cutsvd = cuTSVD(n_components=1, handle=handle)
+@pytest.fixture(scope="module")
+def blobs_data():
+    """Stress dataset, generated on the device once for the whole module"""
+    X, _ = cuml.make_blobs(n_samples=500000, n_features=1000,
+                           random_state=0, dtype=np.float32)
+    return X
 
-    cutsvd.fit(X)
-    cutsvd.handle.sync()
 
-    if name != 'blobs':
-        for attr in ['singular_values_', 'components_',
-                     'explained_variance_ratio_']:
-            with_sign = False if attr in ['components_'] else True
-            assert array_equal(getattr(cutsvd, attr), getattr(sktsvd, attr),
-                               0.4, with_sign=with_sign)
-
-
-@pytest.mark.parametrize('datatype', [np.float32, np.float64])
-@pytest.mark.parametrize('use_handle', [True, False])
-@pytest.mark.parametrize('name', [unit_param(None), quality_param('random'),
-                         stress_param('blobs')])
-def test_tsvd_fit_transform(datatype, name, use_handle):
+def _get_data(name, datatype, request):
     if name == 'blobs':
-        X, y = make_blobs(n_samples=500000,
-                          n_features=1000, random_state=0)
+        return request.getfixturevalue('blobs_data')
 
     elif name == 'random':
         pytest.skip('fails when using random dataset '
                     'used by sklearn for testing')
         shape = 5000, 100
         rng = check_random_state(42)
-        X = rng.randint(-100, 20, np.product(shape)).reshape(shape)
+        return rng.randint(-100, 20, np.product(shape)).reshape(shape)
 
     else:
-        X = np.array([[-1, -1], [-2, -1], [-3, -2], [1, 1], [2, 1], [3, 2]],
-                     dtype=datatype)
+        return np.array([[-1, -1], [-2, -1], [-3, -2], [1, 1], [2, 1],
+                         [3, 2]], dtype=datatype)
+
+
+@pytest.fixture(scope="module")
+def fitted_tsvd(request, tsvd_handle):
+    """cuML's TruncatedSVD (and sklearn's, except for the blobs dataset)
+    fit on the dataset for request.param = (datatype, name) with the
+    handle from tsvd_handle, shared by all the ops tested on it:
+    (name, X, cutsvd, Xcutsvd, sktsvd, Xsktsvd)"""
+    datatype, name = request.param
+    X = _get_data(name, datatype, request)
+    handle, stream = tsvd_handle
 
+    sktsvd, Xsktsvd = None, None
     if name != 'blobs':
-        skpca = skTSVD(n_components=1)
-        Xsktsvd = skpca.fit_transform(X)
+        sktsvd = skTSVD(n_components=1)
+        Xsktsvd = sktsvd.fit_transform(X)
 
-    handle, stream = get_handle(use_handle)
     cutsvd = cuTSVD(n_components=1, handle=handle)
-
     Xcutsvd = cutsvd.fit_transform(X)
     cutsvd.handle.sync()
+    return name, X, cutsvd, Xcutsvd, sktsvd, Xsktsvd
 
-    if name != 'blobs':
-        assert array_equal(Xcutsvd, Xsktsvd, 1e-3, with_sign=True)
 
+# (datatype, name); float32 already covers the blobs stress path
+TSVD_DATA = [unit_param((np.float32, None), id='float32-None'),
+             unit_param((np.float64, None), id='float64-None'),
+             quality_param((np.float32, 'random'), id='float32-random'),
+             quality_param((np.float64, 'random'), id='float64-random'),
+             stress_param((np.float32, 'blobs'), id='float32-blobs')]
 
-@pytest.mark.parametrize('datatype', [np.float32, np.float64])
-@pytest.mark.parametrize('use_handle', [True, False])
-@pytest.mark.parametrize('name', [unit_param(None), quality_param('random'),
-                         stress_param('blobs')])
-def test_tsvd_inverse_transform(datatype, name, use_handle):
 
-    if name == 'blobs':
+@pytest.mark.parametrize('op', ['fit', 'fit_transform', 'inverse_transform'])
+@pytest.mark.parametrize('tsvd_handle', [True, False], indirect=True)
+@pytest.mark.parametrize('fitted_tsvd', TSVD_DATA, indirect=True)
+def test_tsvd(op, tsvd_handle, fitted_tsvd):
+    name, X, cutsvd, Xcutsvd, sktsvd, Xsktsvd = fitted_tsvd
+    if name == 'blobs' and op == 'inverse_transform':
         pytest.skip('fails when using blobs dataset')
-        X, y = make_blobs(n_samples=500000,
-                          n_features=1000, random_state=0)
-
-    elif name == 'random':
-        pytest.skip('fails when using random dataset '
-                    'used by sklearn for testing')
-        shape = 5000, 100
-        rng = check_random_state(42)
-        X = rng.randint(-100, 20, np.product(shape)).reshape(shape)
 
-    else:
-        X = np.array([[-1, -1], [-2, -1], [-3, -2], [1, 1], [2, 1], [3, 2]],
-                     dtype=datatype)
+    if op == 'fit':
+        if name != 'blobs':
+            for attr in ['singular_values_', 'components_',
+                         'explained_variance_ratio_']:
+                with_sign = False if attr in ['components_'] else True
+                assert array_equal(getattr(cutsvd, attr),
+                                   getattr(sktsvd, attr),
+                                   0.4, with_sign=with_sign)
 
-    cutsvd = cuTSVD(n_components=1)
-    Xcutsvd = cutsvd.fit_transform(X)
-    input_gdf = cutsvd.inverse_transform(Xcutsvd)
+    elif op == 'fit_transform':
+        if name != 'blobs':
+            assert array_equal(Xcutsvd, Xsktsvd, 1e-3, with_sign=True)
 
-    cutsvd.handle.sync()
-    assert array_equal(input_gdf, X, 0.4, with_sign=True)
+    else:
+        # inverse_transform(fit_transform(X)) is the projection X V^T V
+        VT = to_nparray(cutsvd.components_)
+        X_proj = np.dot(np.dot(X, VT.T), VT)
+
+        input_gdf = cutsvd.inverse_transform(Xcutsvd)
+        cutsvd.handle.sync()
+        assert array_equal(input_gdf, X_proj, 1e-3, with_sign=True)
+        assert array_equal(input_gdf, X, 0.4, with_sign=True)